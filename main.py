@@ -1,19 +1,86 @@
 import os
-import tempfile
+import io
+import asyncio
+import re
+import random
 import time
 import logging
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+import logging.handlers
+import queue
+import traceback
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import uvicorn
+import orjson
+import redis.asyncio as aioredis
+from redis.exceptions import ResponseError
+from blake3 import blake3
+from cachetools import LRUCache, TTLCache
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from groq import Groq
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from groq import AsyncGroq
 from dotenv import load_dotenv
+from prompts import QUESTION_PREFIX, STYLE_PROMPTS
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+load_dotenv()
+
+# Set up logging - request code only enqueues records; background threads
+# format and write them, so stdout I/O stays off the event loop
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_output)
+logging.basicConfig(level=LOG_LEVEL, handlers=[_DeferredQueueHandler(_log_queue)])
+_log_listener.start()
 logger = logging.getLogger(__name__)
 
-load_dotenv()
+# uvicorn's loggers don't propagate to root and write through their own
+# StreamHandlers. uvicorn configures them before startup, which then puts each
+# one's handlers behind a queue too, so the access log is written off the loop.
+UVICORN_LOGGERS = ("uvicorn", "uvicorn.error", "uvicorn.access")
+_uvicorn_log_listeners = []
+
+def _queue_uvicorn_logs():
+    for name in UVICORN_LOGGERS:
+        uvicorn_logger = logging.getLogger(name)
+        if not uvicorn_logger.handlers:
+            continue
+        uvicorn_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(uvicorn_queue, *uvicorn_logger.handlers, respect_handler_level=True)
+        uvicorn_logger.handlers = [_DeferredQueueHandler(uvicorn_queue)]
+        listener.start()
+        _uvicorn_log_listeners.append((uvicorn_logger, listener))
+
+def _restore_uvicorn_logs():
+    # uvicorn keeps logging after the app shuts down, so hand its handlers back
+    for uvicorn_logger, listener in _uvicorn_log_listeners:
+        listener.stop()
+        uvicorn_logger.handlers = list(listener.handlers)
+    _uvicorn_log_listeners.clear()
 
-app = FastAPI(title="CerebroEcho API", version="1.2.0")
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+REDIS_URL = os.getenv("REDIS_URL")
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Trial counters and the answer cache are only shared across workers through
+# Redis - without it each worker keeps its own copies. uvicorn sizes its worker
+# pool from WEB_CONCURRENCY, which the platform may set on its own; an explicit
+# --workers isn't visible here.
+if WEB_CONCURRENCY > 1 and not REDIS_URL:
+    logger.warning(
+        "⚠️ WEB_CONCURRENCY=%d without REDIS_URL - each worker keeps its own usage counters and cache",
+        WEB_CONCURRENCY
+    )
+
+
+app = FastAPI(title="CerebroEcho API", version="1.2.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,37 +89,369 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Shared connection pool so every Groq call reuses warm keep-alive sockets.
+# HTTP/2 multiplexes concurrent calls as streams over a few connections;
+# httpx falls back to HTTP/1.1 if ALPN negotiation doesn't offer h2.
+_HTTP = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=300),
+    timeout=httpx.Timeout(30.0, connect=5.0),
+)
+
+# Cap in-flight Groq calls so bursts queue here instead of tripping rate limits.
+# The SDK already retries 429s and connection errors with exponential backoff.
+GROQ_MAX_CONCURRENCY = 32
+GROQ_MAX_RETRIES = 2
+_GROQ_GATE = asyncio.Semaphore(GROQ_MAX_CONCURRENCY)
+
+# Bounded pool for anything that still has to run off-loop (DNS lookups from
+# the httpx pool, any sync fallback) - installed as the loop's default executor
+_SYNC_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="groq")
+
 # Safe Groq client initialization
 client = None
 try:
-    api_key = os.getenv("GROQ_API_KEY")
-    if not api_key:
+    if not GROQ_API_KEY:
         logger.warning("⚠️ GROQ_API_KEY not set")
     else:
-        client = Groq(api_key=api_key)
+        client = AsyncGroq(api_key=GROQ_API_KEY, http_client=_HTTP, max_retries=GROQ_MAX_RETRIES)
         logger.info("✅ Groq client initialized successfully")
 except Exception as e:
-    logger.error(f"❌ ERROR creating Groq client: {e}")
+    logger.error("❌ ERROR creating Groq client: %s", e)
     client = None
 
-usage_tracker = {}
+# Optional shared cache - falls back to in-process only when Redis is absent.
+# A blocking pool makes bursts wait for a free connection instead of failing
+# over to the per-process fallbacks, which would split the usage counters.
+REDIS_MAX_CONNECTIONS = 50
+REDIS_POOL_TIMEOUT = 5
+redis_client = None
+try:
+    if not REDIS_URL:
+        logger.warning("⚠️ REDIS_URL not set - cache and usage counters are in-process only")
+    else:
+        redis_client = aioredis.Redis.from_pool(aioredis.BlockingConnectionPool.from_url(
+            REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT
+        ))
+        logger.info("✅ Redis client initialized successfully")
+except Exception as e:
+    logger.error("❌ ERROR creating Redis client: %s", e)
+    redis_client = None
+
+# Usage counters: atomic and shared in Redis, bounded LRU when Redis is absent
+LIMITS_DEFAULT = 10
+LIMITS_OVERRIDE = {"anonymous": 5}
+USAGE_TTL = 86400 * 30
+_local_usage = LRUCache(maxsize=100_000)
+
+async def _incr_usage(user_key: str) -> int:
+    if redis_client is not None:
+        try:
+            # INCR + EXPIRE in one round-trip; the TTL slides with each counted question
+            key = f"usage:{user_key}"
+            count, _ = await redis_client.pipeline(transaction=False).incr(key).expire(key, USAGE_TTL).execute()
+            return count
+        except Exception as e:
+            logger.warning("⚠️ Redis usage write failed: %s", e)
+    count = _local_usage.get(user_key, 0) + 1
+    _local_usage[user_key] = count
+    return count
+
+async def _decr_usage(user_key: str) -> int:
+    # Hands back a slot reserved by _incr_usage for a question that wasn't answered
+    if redis_client is not None:
+        try:
+            return await redis_client.decr(f"usage:{user_key}")
+        except Exception as e:
+            logger.warning("⚠️ Redis usage write failed: %s", e)
+    count = max(_local_usage.get(user_key, 0) - 1, 0)
+    _local_usage[user_key] = count
+    return count
+
+async def _move_usage(old_key: str, new_key: str):
+    if redis_client is not None:
+        try:
+            await redis_client.rename(f"usage:{old_key}", f"usage:{new_key}")
+        except ResponseError:
+            pass  # Nothing recorded under the old key yet
+        except Exception as e:
+            logger.warning("⚠️ Redis usage rename failed: %s", e)
+        return
+    if old_key in _local_usage:
+        _local_usage[new_key] = _local_usage.pop(old_key)
+
+CHAT_MODEL = "llama-3.1-8b-instant"
+
+# Answer cache: hot keys in-process, everything else shared through Redis
+ANSWER_CACHE_TTL = 86400
+_local_answers = TTLCache(maxsize=4096, ttl=3600)
+_WHITESPACE = re.compile(r"\s+")
+
+def _answer_cache_key(style: str, context: str, work_history: str, question: str) -> str:
+    q_norm = _WHITESPACE.sub(" ", question.strip().lower())
+    raw = f"{CHAT_MODEL}|{style}|{context}|{work_history}|{q_norm}"
+    return "ans:" + blake3(raw.encode()).hexdigest(length=16)
+
+async def _get_cached_answer(key: str):
+    answer = _local_answers.get(key)
+    if answer is not None or redis_client is None:
+        return answer
+    try:
+        cached = await redis_client.get(key)
+    except Exception as e:
+        logger.warning("⚠️ Redis cache read failed: %s", e)
+        return None
+    if cached is None:
+        return None
+    answer = cached.decode()
+    _local_answers[key] = answer
+    return answer
+
+async def _set_cached_answer(key: str, answer: str):
+    if not answer:
+        return
+    _local_answers[key] = answer
+    if redis_client is None:
+        return
+    try:
+        await redis_client.setex(key, ANSWER_CACHE_TTL, answer)
+    except Exception as e:
+        logger.warning("⚠️ Redis cache write failed: %s", e)
+
+# Non-streaming hot path talks to Groq directly: no SDK request/response models,
+# the answer is read straight out of the JSON. Retries mirror the SDK's policy,
+# and backoff sleeps happen outside the concurrency gate.
+GROQ_CHAT_URL = "https://api.groq.com/openai/v1/chat/completions"
+_GROQ_HEADERS = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
+GROQ_RETRY_BASE_DELAY = 0.5
+GROQ_RETRY_MAX_DELAY = 8.0
+
+def _should_retry(resp: httpx.Response) -> bool:
+    should_retry = resp.headers.get("x-should-retry")
+    if should_retry == "true":
+        return True
+    if should_retry == "false":
+        return False
+    return resp.status_code in (408, 409, 429) or resp.status_code >= 500
+
+def _retry_after(resp: httpx.Response):
+    try:
+        retry_after_ms = resp.headers.get("retry-after-ms")
+        if retry_after_ms is not None:
+            return float(retry_after_ms) / 1000
+        retry_after = resp.headers.get("retry-after")
+        if retry_after is None:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            return parsedate_to_datetime(retry_after).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+def _retry_delay(attempt: int, resp=None) -> float:
+    if resp is not None:
+        retry_after = _retry_after(resp)
+        if retry_after is not None and 0 < retry_after <= 60:
+            return retry_after
+    # Exponential backoff with jitter so a 429 burst doesn't retry in lockstep
+    delay = min(GROQ_RETRY_BASE_DELAY * 2 ** attempt, GROQ_RETRY_MAX_DELAY)
+    return delay * (1 - 0.25 * random.random())
+
+async def _post_completion(payload: dict) -> str:
+    body = orjson.dumps(payload)
+    for attempt in range(GROQ_MAX_RETRIES + 1):
+        last_attempt = attempt == GROQ_MAX_RETRIES
+        resp = None
+        try:
+            async with _GROQ_GATE:
+                resp = await _HTTP.post(GROQ_CHAT_URL, headers=_GROQ_HEADERS, content=body)
+        except httpx.TransportError:
+            if last_attempt:
+                raise
+        else:
+            if resp.is_success or last_attempt or not _should_retry(resp):
+                resp.raise_for_status()
+                return orjson.loads(resp.content)["choices"][0]["message"]["content"]
+        await asyncio.sleep(_retry_delay(attempt, resp))
+
+async def _create_completion(**kwargs):
+    if not kwargs.get("stream"):
+        return await _post_completion(kwargs)
+    async with _GROQ_GATE:
+        return await client.chat.completions.create(**kwargs)
+
+# Connection warm-up: open the pooled (HTTP/2-multiplexed) connection to Groq
+# in the background, then keep pinging it so it isn't closed while idle
+KEEPALIVE_PING_INTERVAL = 25
+_background_tasks = []
+
+async def _ping_groq() -> bool:
+    try:
+        await client.models.list()
+    except Exception as e:
+        logger.warning("⚠️ Groq warm-up ping failed: %s", e)
+        return False
+    return True
+
+async def _keepalive_loop():
+    if await _ping_groq():
+        logger.info("🔥 Groq connection warmed")
+    # Ping well inside any upstream idle timeout so the pooled connection stays open
+    while True:
+        await asyncio.sleep(KEEPALIVE_PING_INTERVAL)
+        await _ping_groq()
+
+# Founder spots: one shared number, re-rolled on a timer and kept pre-encoded.
+# Seeding from the refresh window gives every worker the same number.
+FOUNDER_SPOTS_REFRESH = 10
+_FOUNDER_SPOTS_HEADERS = {"Cache-Control": f"public, max-age={FOUNDER_SPOTS_REFRESH}"}
+
+def _encode_founder_spots() -> bytes:
+    window = int(time.time() // FOUNDER_SPOTS_REFRESH)
+    return orjson.dumps({"remaining": random.Random(window).randint(12, 47)})
+
+_founder_spots_body = _encode_founder_spots()
+
+async def _founder_spots_loop():
+    global _founder_spots_body
+    while True:
+        await asyncio.sleep(FOUNDER_SPOTS_REFRESH - time.time() % FOUNDER_SPOTS_REFRESH)
+        _founder_spots_body = _encode_founder_spots()
+
+@app.on_event("startup")
+async def startup():
+    _queue_uvicorn_logs()
+    asyncio.get_running_loop().set_default_executor(_SYNC_POOL)
+    _background_tasks.append(asyncio.create_task(_founder_spots_loop()))
+    if client is None:
+        return
+    _background_tasks.append(asyncio.create_task(_keepalive_loop()))
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in _background_tasks:
+        task.cancel()
+    await _HTTP.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+    _SYNC_POOL.shutdown(wait=False)
+    _restore_uvicorn_logs()
+    _log_listener.stop()
+
+def _elapsed(start_ns: int) -> float:
+    return (time.monotonic_ns() - start_ns) / 1e9
+
+# Whisper output that is filler or a known silence hallucination isn't worth an LLM call
+FILLER = {"um", "uh", "hmm", "ok", "okay", "yeah"}
+BLACKLIST = {"thank you", "thank you for watching", "thanks for watching", "bye"}
+_PUNCTUATION = str.maketrans("", "", ".,!?")
+
+def _is_noise(transcript: str) -> bool:
+    words = transcript.lower().translate(_PUNCTUATION).split()
+    if len(words) < 2 or " ".join(words) in BLACKLIST:
+        return True
+    return all(word in FILLER for word in words)
+
+# Starlette's multipart parser keeps uploads up to 1MB in memory and rolls
+# larger ones over to a temp file
+UPLOAD_SPOOL_SIZE = 1024 * 1024
+
+# Container signatures recorders actually send, mapped to the filename and MIME
+# type Groq should see: WebM/Matroska, Ogg, WAV, MP3 (ID3), FLAC, MP4/M4A
+# ("ftyp" box at offset 4, Safari) and bare MPEG audio frame sync
+AUDIO_FORMATS = (
+    (b"\x1a\x45\xdf\xa3", ("audio.webm", "audio/webm")),
+    (b"OggS", ("audio.ogg", "audio/ogg")),
+    (b"RIFF", ("audio.wav", "audio/wav")),
+    (b"ID3", ("audio.mp3", "audio/mpeg")),
+    (b"fLaC", ("audio.flac", "audio/flac")),
+)
+_MP4_FORMAT = ("audio.m4a", "audio/mp4")
+_MP3_FORMAT = ("audio.mp3", "audio/mpeg")
+
+def _detect_audio_format(header: bytes):
+    for magic, audio_format in AUDIO_FORMATS:
+        if header.startswith(magic):
+            return audio_format
+    if header[4:8] == b"ftyp":
+        return _MP4_FORMAT
+    # Frame sync with a non-zero layer field (zero would be AAC/ADTS, which Groq rejects)
+    if len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0 and header[1] & 0x06:
+        return _MP3_FORMAT
+    return None
+
+def _listening_response(questions_used: int, start_ns: int) -> dict:
+    return {
+        "answer": "Listening...",
+        "transcript": "",
+        "questions_used": questions_used,
+        "processing_time": round(_elapsed(start_ns), 3)
+    }
+
+def _sse(event: str, data: dict) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+async def _completion_tokens(completion_stream):
+    # Close the upstream stream on every exit, including client disconnects
+    async with completion_stream:
+        async for chunk in completion_stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+async def _cached_tokens(answer: str):
+    yield answer
+
+async def _stream_answer(tokens, transcript, user_key, questions_used, start_ns, device_id, cache_key=None):
+    # Forward tokens as they arrive so the client sees the first words right away
+    yield _sse("transcript", {"transcript": transcript})
+    
+    parts = []
+    first_token_time = None
+    try:
+        async for token in tokens:
+            if first_token_time is None:
+                first_token_time = _elapsed(start_ns)
+                logger.info("⚡ First token in %.2fs", first_token_time)
+            parts.append(token)
+            yield _sse("token", {"content": token})
+    except Exception as e:
+        logger.error("❌ STREAM ERROR: %s", e)
+        await _decr_usage(user_key)
+        yield _sse("error", {"detail": f"Processing error: {str(e)}"})
+        return
+    
+    answer = "".join(parts).strip()
+    if cache_key is not None:
+        await _set_cached_answer(cache_key, answer)
+    processing_time = round(_elapsed(start_ns), 3)
+    logger.info("[AUDIO PROCESSED] Device: %s | Q: %.50s... | Streamed in: %.3fs", device_id, transcript, processing_time)
+    
+    yield _sse("done", {
+        "transcript": transcript,
+        "answer": answer,
+        "questions_used": questions_used,
+        "processing_time": processing_time
+    })
 
 @app.get("/")
 async def root():
     return {"status": "CerebroEcho Backend Live", "version": "1.2.0"}
 
+# Configuration is fixed at import time, so the health payload is too
+_HEALTH_BODY = orjson.dumps({
+    "status": "ok",
+    "groq_configured": client is not None,
+    "api_key_present": bool(GROQ_API_KEY)
+})
+
 @app.get("/health")
 async def health():
-    return {
-        "status": "ok", 
-        "groq_configured": client is not None,
-        "api_key_present": bool(os.getenv("GROQ_API_KEY"))
-    }
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 @app.get("/founder_spots")
 async def get_founder_spots():
-    import random
-    return {"remaining": random.randint(12, 47)}
+    return Response(content=_founder_spots_body, media_type="application/json", headers=_FOUNDER_SPOTS_HEADERS)
 
 @app.post("/process_audio")
 async def process_audio(
@@ -62,7 +461,8 @@ async def process_audio(
     userEmail: str = Form("anonymous"),
     context: str = Form("a professional role"),
     work_history: str = Form(""),
-    style: str = Form("script")
+    style: str = Form("script"),
+    stream: bool = Form(False)
 ):
     # Check if Groq is available
     if client is None:
@@ -76,12 +476,14 @@ async def process_audio(
     if not actual_file:
         raise HTTPException(status_code=400, detail="No audio file provided")
     
-    # Usage tracking
-    user_key = f"{deviceId}_{userEmail}"
-    current_used = usage_tracker.get(user_key, 0)
-    limit = 10 if userEmail != "anonymous" else 5
+    # Usage tracking - reserve the question up front so concurrent uploads can't
+    # all pass the check; exits that don't produce an answer hand it back
+    user_key = deviceId + "_" + userEmail
+    questions_used = await _incr_usage(user_key)
+    limit = LIMITS_OVERRIDE.get(userEmail, LIMITS_DEFAULT)
     
-    if current_used >= limit:
+    if questions_used > limit:
+        await _decr_usage(user_key)
         raise HTTPException(
             status_code=403,
             detail={
@@ -90,107 +492,121 @@ async def process_audio(
             }
         )
     
-    temp_filename = None
-    
     try:
-        start_time = time.time()
+        start_ns = time.monotonic_ns()
         
-        # Read audio content
-        content = await actual_file.read()
+        # Use the size recorded by the multipart parser; only measure the file if it's missing
+        audio_file = actual_file.file
+        audio_size = actual_file.size
+        if audio_size is None:
+            audio_file.seek(0, os.SEEK_END)
+            audio_size = audio_file.tell()
+            audio_file.seek(0)
         
         # Reject tiny files (likely noise or empty clicks)
-        if len(content) < 1000:
-            logger.warning(f"⚠️ Audio too small: {len(content)} bytes")
-            return {
-                "answer": "Listening...",
-                "transcript": "",
-                "questions_used": current_used,
-                "processing_time": round(time.time() - start_time, 3)
-            }
+        if audio_size < 1000:
+            logger.warning("⚠️ Audio too small: %d bytes", audio_size)
+            return _listening_response(await _decr_usage(user_key), start_ns)
+        
+        # A spilled upload is read back through UploadFile.read(), which runs on the
+        # threadpool, so neither the header check nor the httpx multipart encoder
+        # reads the temp file synchronously on the event loop
+        if audio_size > UPLOAD_SPOOL_SIZE:
+            audio_file = io.BytesIO(await actual_file.read())
         
-        logger.info(f"📝 Transcribing {len(content)} bytes...")
+        # Malformed uploads would only buy an empty transcription
+        header = audio_file.read(12)
+        audio_file.seek(0)
+        audio_format = _detect_audio_format(header)
+        if audio_format is None:
+            logger.warning("⚠️ Unrecognized audio header: %r", header[:4])
+            await _decr_usage(user_key)
+            raise HTTPException(status_code=400, detail="Unsupported audio format")
         
-        # Save to temp file with .webm extension
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as temp_file:
-            temp_file.write(content)
-            temp_filename = temp_file.name
+        logger.info("📝 Transcribing %d bytes...", audio_size)
         
-        # THE FIX: Add "audio/webm" as the 3rd parameter in the tuple
-        with open(temp_filename, "rb") as audio_file:
-            transcription = client.audio.transcriptions.create(
-                file=(temp_filename, audio_file.read(), "audio/webm"),  # ✅ MIME type added
+        # Hand the upload straight to Groq, labelled with the detected container
+        filename, mime_type = audio_format
+        async with _GROQ_GATE:
+            transcription = await client.audio.transcriptions.create(
+                file=(filename, audio_file, mime_type),
                 model="whisper-large-v3-turbo",
                 response_format="text",
             )
         
-        # Clean up temp file
-        if temp_filename and os.path.exists(temp_filename):
-            os.unlink(temp_filename)
-            temp_filename = None
-        
         transcript = transcription.strip() if transcription else ""
         
-        if not transcript or len(transcript) < 2:
-            return {
-                "answer": "Listening...",
-                "transcript": "",
-                "questions_used": current_used,
-                "processing_time": round(time.time() - start_time, 3)
-            }
+        if not transcript or _is_noise(transcript):
+            logger.info("🔇 Skipping non-question transcript: %.50s", transcript)
+            return _listening_response(await _decr_usage(user_key), start_ns)
         
-        logger.info(f"✅ Transcript: {transcript[:50]}...")
+        logger.info("✅ Transcript: %.50s...", transcript)
         
         # Generate answer based on style
-        if style == "shorthand":
-            system_prompt = f"""You are an elite interview coach. The candidate is interviewing for {context}.
-Their background: {work_history}
-Provide ONE hint or framework name only. Max 10 words."""
-            max_tokens = 50
-        elif style == "bullet":
-            system_prompt = f"""You are an elite interview coach. The candidate is interviewing for {context}.
-Their background: {work_history}
-Provide 3 tactical bullet points. Max 100 words total."""
-            max_tokens = 200
-        else:
-            system_prompt = f"""You are an elite interview coach. The candidate is interviewing for {context}.
-Their background: {work_history}
-Provide a 2-3 sentence tactical answer. Be concise and confident."""
-            max_tokens = 150
-        
-        completion = client.chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Interview question: {transcript}"}
-            ],
-            temperature=0.6,
-            max_tokens=max_tokens,
-            top_p=0.9
-        )
+        if style not in STYLE_PROMPTS:
+            style = "script"
+        prompt_tmpl, max_tokens = STYLE_PROMPTS[style]
+        system_prompt = prompt_tmpl.format(context=context, work_history=work_history)
+        
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": QUESTION_PREFIX + transcript}
+        ]
+        
+        # Repeat questions are answered straight from the cache
+        cache_key = _answer_cache_key(style, context, work_history, transcript)
+        cached_answer = await _get_cached_answer(cache_key)
+        
+        # Streaming mode: send tokens over SSE instead of waiting for the full answer
+        if stream:
+            if cached_answer is not None:
+                tokens = _cached_tokens(cached_answer)
+                cache_key = None
+            else:
+                tokens = _completion_tokens(await _create_completion(
+                    model=CHAT_MODEL,
+                    messages=messages,
+                    temperature=0.6,
+                    max_tokens=max_tokens,
+                    top_p=0.9,
+                    stream=True
+                ))
+            return StreamingResponse(
+                _stream_answer(tokens, transcript, user_key, questions_used, start_ns, deviceId, cache_key),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
         
-        answer = completion.choices[0].message.content.strip()
-        usage_tracker[user_key] = current_used + 1
-        processing_time = time.time() - start_time
+        if cached_answer is not None:
+            answer = cached_answer
+            logger.info("💾 Answer served from cache")
+        else:
+            answer = await _create_completion(
+                model=CHAT_MODEL,
+                messages=messages,
+                temperature=0.6,
+                max_tokens=max_tokens,
+                top_p=0.9
+            )
+            answer = answer.strip()
+            await _set_cached_answer(cache_key, answer)
         
-        logger.info(f"✅ Answer generated in {processing_time:.2f}s")
-        logger.info(f"[AUDIO PROCESSED] Device: {deviceId} | Q: {transcript[:50]}... | Time: {processing_time:.3f}s")
+        processing_time = round(_elapsed(start_ns), 3)
+        logger.info("[AUDIO PROCESSED] Device: %s | Q: %.50s... | Time: %.3fs", deviceId, transcript, processing_time)
         
         return {
             "transcript": transcript,
             "answer": answer,
-            "questions_used": usage_tracker[user_key],
-            "processing_time": round(processing_time, 3)
+            "questions_used": questions_used,
+            "processing_time": processing_time
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"❌ ERROR: {str(e)}")
-        import traceback
+        logger.error("❌ ERROR: %s", e)
         logger.error(traceback.format_exc())
-        
-        # Cleanup on error
-        if temp_filename and os.path.exists(temp_filename):
-            os.unlink(temp_filename)
-        
+        await _decr_usage(user_key)
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
 
 @app.post("/save_email")
@@ -200,13 +616,10 @@ async def save_email(data: dict):
     old_key = f"{device_id}_anonymous"
     new_key = f"{device_id}_{email}"
     
-    if old_key in usage_tracker:
-        usage_tracker[new_key] = usage_tracker[old_key]
-        del usage_tracker[old_key]
+    await _move_usage(old_key, new_key)
     
-    logger.info(f"📧 Email saved: {email}")
+    logger.info("📧 Email saved: %s", email)
     return {"status": "success", "message": "Trial extended to 10 questions"}
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools")